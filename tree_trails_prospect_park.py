@@ -14,89 +14,151 @@
 # 
 # You will need to install the following Python libraries (all available with pip):
 # - requests
+# - requests-cache
 # - lxml
-# - jsonlines
-# - spacy
-# 
+# - orjson
+# - spacy (3.x)
+# - flashtext
+# - numpy
+#
 # If you want to skip directly to installing and loading the data, follow the instructions in [importing-database-data.md](importing-database-data.md).
 
-#You may need to install the requests, lxml, jsonlines, and spacy libraries before you start. All can be installed with pip.
+#You may need to install the requests, requests-cache, lxml, orjson, spacy, flashtext, and numpy libraries before you start. All can be installed with pip.
 
 import requests
+import requests_cache
 import csv
+import hashlib
 import json
 import time
+from itertools import chain, islice
+from pathlib import Path
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
 from lxml import etree as et
-import jsonlines
+import numpy as np
+import orjson
 import re
 import spacy
-from spacy.pipeline import EntityRuler
+from spacy.tokens import DocBin
+from flashtext import KeywordProcessor
+
+
+#cache HTTP responses in a local sqlite file so re-running the notebook during development
+#doesn't re-hit Wikipedia and Wikidata--the data is stable across iterations. POST is included
+#so the WDQS SPARQL queries are cached too. Set refresh = True (or delete http_cache.sqlite)
+#if you want to force fresh downloads
+requests_cache.install_cache('http_cache', backend='sqlite', expire_after=86400,
+                             allowable_methods=('GET', 'POST'))
+refresh = False
+if refresh:
+    requests_cache.clear()
+
+#use a single session for all requests so we get keep-alive and connection pooling,
+#with a User-Agent that identifies this project per the WDQS etiquette guidelines
+SESSION = requests.Session()
+SESSION.headers['User-Agent'] = 'tree-trails-prospect-park/1.0 (https://github.com/saverkamp/tree-trails-prospect-park)'
+
+#cap how many requests can be in flight at once and how fast we issue them, so the
+#threaded batches below stay polite to the Wikimedia APIs
+request_gate = threading.Semaphore(4)
+rate_lock = threading.Lock()
+next_request_at = 0.0
+
+def rateLimit(interval=1.0):
+    """Block until at least interval seconds have passed since the last permitted request"""
+    global next_request_at
+    with rate_lock:
+        now = time.monotonic()
+        wait = next_request_at - now
+        next_request_at = max(now, next_request_at) + interval
+    if wait > 0:
+        time.sleep(wait)
 
 
 # ## Get a list of tree species
 # 
 # There isn't a great way to query Wikidata for all tree species, so I scraped all listed species from this [Wikpedia list of trees and shrubs by taxonomic family](https://en.wikipedia.org/wiki/List_of_trees_and_shrubs_by_taxonomic_family) using lxml's xpath() function to get the Wikipedia article titles and species names.
 
-#use lxml's HTMLParser to put the html content into a searchable tree structure
-parser = et.HTMLParser()
-html = requests.get('https://en.wikipedia.org/wiki/List_of_trees_and_shrubs_by_taxonomic_family').content
-tree = et.fromstring(html, parser)
-
-#limit results to all table row (<tr>) elements in the html
-rows = tree.xpath('//tr')
+#stream the table row (<tr>) elements with lxml's iterparse instead of materializing the
+#whole DOM of the (large) list page, clearing each row once we've pulled what we need
+html = SESSION.get('https://en.wikipedia.org/wiki/List_of_trees_and_shrubs_by_taxonomic_family').content
 
-#Within each <tr>, the first table data (<td>) element contains the species information we need, so add each of those to a list
-species = []
-for row in rows:
-    if len(row.xpath('td')) > 0:
-        s = row.xpath('./td')[0]
-        species.append(s)
+#pre-compile the lookups run on every table row so the path expressions are parsed only once
+TD_XP = et.XPath('td')
+A_XP = et.XPath('a')
 
-#Within each of these <td> elements, the species name and Wikipedia links are in the @title and @href attributes
 tree_species = []
-for s in species:
-    if len(s.xpath('a/@href')) > 0:
-        #extract the name and wiki_link from each of the results matching the xpath above
-        ts = {}
-        ts['name'] = s.xpath('a/@title')[0]
-        ts['wiki_link'] = s.xpath('a/@href')[0]
-        #except some of these pages are not species, so skip those
-        if ts['name'] not in ['Least-concern species', 'Vulnerable species', 'Endangered species', 'Critically endangered']:
-            tree_species.append(ts)
-    
+for _, row in et.iterparse(BytesIO(html), html=True, tag='tr'):
+    #Within each <tr>, the first table data (<td>) element contains the species information we
+    #need--the species name and Wikipedia link are in the @title and @href attributes of its <a>
+    tds = TD_XP(row)
+    if len(tds) > 0:
+        links = A_XP(tds[0])
+        a = links[0] if len(links) > 0 else None
+        if a is not None and a.get('href') is not None and a.get('title') is not None:
+            ts = {}
+            ts['name'] = a.get('title')
+            ts['wiki_link'] = a.get('href')
+            #except some of these pages are not species, so skip those
+            if ts['name'] not in ['Least-concern species', 'Vulnerable species', 'Endangered species', 'Critically endangered']:
+                tree_species.append(ts)
+    #free the row (and any fully parsed siblings before it) so memory stays flat
+    row.clear()
+    while row.getprevious() is not None:
+        del row.getparent()[0]
+
 
 
 # ### Get Wikidata ids for each tree species
-# 
-# With the Wikipedia article names from the scraped list, you can use the Wikipedia API to get the corresponding Wikidata id.
+#
+# With the Wikipedia article names from the scraped list, you can use the Wikipedia API to get the corresponding Wikidata ids, up to 50 titles per call.
+
+def chunkList(items, size):
+    """Split a list into chunks of at most size items"""
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
 
-def getWikidataId(wp_id):
-    """Get Wikidata id for a given Wikipedia article title"""
+def getWikidataIdsBatch(titles):
+    """Get Wikidata ids for a batch of up to 50 Wikipedia article titles in a single API call"""
     base = 'https://en.wikipedia.org/w/api.php?action=query&prop=pageprops&ppprop=wikibase_item&redirects=1&format=json&titles='
-    url = base + wp_id
-    query = requests.get(url)
-    wd_id = None
+    url = base + '|'.join(requests.utils.quote(t, safe='') for t in titles)
+    with request_gate:
+        rateLimit()
+        query = SESSION.get(url)
     response = json.loads(query.content)
-    for k, v in response['query']['pages'].items():
+    #the API reports back any title normalization and redirects it applied, so map the
+    #canonical titles in the response back to the titles we asked for
+    canonical = {}
+    for n in response['query'].get('normalized', []):
+        canonical[n['to']] = n['from']
+    for r in response['query'].get('redirects', []):
+        canonical[r['to']] = canonical.get(r['from'], r['from'])
+    wd_ids = {}
+    for v in response['query']['pages'].values():
         if 'pageprops' in v:
-            wd_id = v['pageprops']['wikibase_item']
-    return wd_id
-
-#Call the API to get the corresponding wikidata id and add it to the tree species entry
+            title = canonical.get(v['title'], v['title'])
+            wd_ids[title] = v['pageprops']['wikibase_item']
+    return wd_ids
+
+#Call the API in batches of 50 titles to get the corresponding wikidata ids
+#some trees do not have wikipedia pages, so ignore these
+titles = [ts['name'] for ts in tree_species if 'page does not exist' not in ts['name']]
+wd_ids_by_title = {}
+#overlap the batched calls on a few threads--rateLimit() keeps the request rate in check
+with ThreadPoolExecutor(max_workers=4) as ex:
+    for batch_ids in ex.map(getWikidataIdsBatch, chunkList(titles, 50)):
+        wd_ids_by_title.update(batch_ids)
+
+#add the wikidata id to each tree species entry
 for ts in tree_species:
-    base = 'https://en.wikipedia.org'
-    #some trees do not have wikipedia pages, so ignore these
-    if 'page does not exist' not in ts['name']:
-        wd_id = getWikidataId(ts['name'])
-        if wd_id is not None:
-            ts['wikidata'] = wd_id
-    #Use a 1 second rate limit in between queries
-    time.sleep(1)
+    if ts['name'] in wd_ids_by_title:
+        ts['wikidata'] = wd_ids_by_title[ts['name']]
 
 #saving as we go
-f = open('tree_species.json', 'w')
-json.dump(tree_species, f)
-f.close()
+with open('tree_species.json', 'wb') as f:
+    f.write(orjson.dumps(tree_species, option=orjson.OPT_INDENT_2))
 
 
 # Some species in our text aren't in this list because they are cultivars or technically not trees, so we'll add them now:
@@ -116,40 +178,54 @@ tree_species.extend(addtl_wiki_ids)
 
 # Deduplicate this list, just in case
 
-tree_species = [dict(t) for t in {tuple(d.items()) for d in tree_species}]
+#keep the first occurrence of each (wikidata id, name) pair--the name stays in the key because
+#the same id can legitimately appear under different names (e.g. Q731443 is scraped as
+#'Magnolia × soulangeana' and added above as 'Magnolia soulangeana', and the text only matches
+#the latter), and first-occurrence order keeps the auto-incrementing alt_ids stable
+seen = set()
+deduped = []
+for d in tree_species:
+    key = (d.get('wikidata') or d['name'], d['name'])
+    if key not in seen:
+        seen.add(key)
+        deduped.append(d)
+tree_species = deduped
 
 
 # ### Get Wikidata info on Species: name, common names, Wikipedia Commons link, and iNaturalist id
-# 
-# With the Wikidata ids, use SPARQL to [query Wikidata](https://www.wikidata.org/wiki/Wikidata:SPARQL_tutorial) at the [Wikidata Query Service (WDQS)](https://query.wikidata.org/) for each, retrieving species name, alt label, common names, Wikimedia Commons page (useful for images), and iNaturalist id (for more info and local observations of the species). You can get any ids you want from the Wikidata page, such as NCBI taxonomy ID, USDA Plants ID, or many more. I chose iNaturalist because of the easy interface to photos, commmon names, and local observations. If you want to get additional identifiers or properties back in your query, you can adjust the query below by adding a statement to the WHERE clause similar to `OPTIONAL {{ {} wdt:P3151 ?inaturalist. }}` where `P3151` is the property you want retrieve and `?inaturalist` is a variable name of your choice to represent the property value. Append "Label" to the end of this variable and add it to the SELECT clause to return the value in your query results, (ex. `?inaturalistLabel`). The "OPTIONAL" clause ensures that all of the other results your requesting for the species will be returned even if the value of this property isn't present.  
+#
+# With the Wikidata ids, use SPARQL to [query Wikidata](https://www.wikidata.org/wiki/Wikidata:SPARQL_tutorial) at the [Wikidata Query Service (WDQS)](https://query.wikidata.org/) in batches of up to 50 species at a time, retrieving species name, alt label, common names, Wikimedia Commons page (useful for images), and iNaturalist id (for more info and local observations of the species). You can get any ids you want from the Wikidata page, such as NCBI taxonomy ID, USDA Plants ID, or many more. I chose iNaturalist because of the easy interface to photos, commmon names, and local observations. If you want to get additional identifiers or properties back in your query, you can adjust the query below by adding a statement to the WHERE clause similar to `OPTIONAL {{ ?item wdt:P3151 ?inaturalist. }}` where `P3151` is the property you want retrieve and `?inaturalist` is a variable name of your choice to represent the property value. Append "Label" to the end of this variable and add it to the SELECT clause to return the value in your query results, (ex. `?inaturalistLabel`). The "OPTIONAL" clause ensures that all of the other results your requesting for the species will be returned even if the value of this property isn't present.
 
-def getWikidataBySpecies(request_id):
-    """Function to retrive items and properties by tree species id through the WDQS."""
+def getWikidataBySpeciesBatch(request_ids):
+    """Function to retrive items and properties for a batch of tree species ids through the WDQS
+    in a single request, using a VALUES clause to bind all of the ids at once."""
     #Add additional properties within the select clause as desired
-    wdid = 'wd:' + request_id
+    values = ' '.join('wd:' + r for r in request_ids)
     #doubled curly braces are used here instead of single because you're sending the query using REST
     sparql = """PREFIX wikibase: <http://wikiba.se/ontology#>
             PREFIX wd: <http://www.wikidata.org/entity/>
             PREFIX wdt: <http://www.wikidata.org/prop/direct/>
             PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
-            SELECT ?label ?altLabel ?commonLabel ?inaturalistLabel ?wpcommonsLabel
-            WHERE 
+            SELECT ?item ?label ?altLabel ?commonLabel ?inaturalistLabel ?wpcommonsLabel
+            WHERE
             {{
-              {} rdfs:label ?label .
+              VALUES ?item {{ {} }}
+              ?item rdfs:label ?label .
                 FILTER (langMatches( lang(?label), "EN" ) )
-              OPTIONAL {{ {} skos:altLabel ?altLabel FILTER ( lang(?altLabel) = "en" ). }}
-              OPTIONAL {{ {} wdt:P3151 ?inaturalist. }}
-              OPTIONAL {{ {} wdt:P1843 ?common filter (lang(?common) = "en").}}
-              OPTIONAL {{ {} wdt:P935 ?wpcommons. }}
+              OPTIONAL {{ ?item skos:altLabel ?altLabel FILTER ( lang(?altLabel) = "en" ). }}
+              OPTIONAL {{ ?item wdt:P3151 ?inaturalist. }}
+              OPTIONAL {{ ?item wdt:P1843 ?common filter (lang(?common) = "en").}}
+              OPTIONAL {{ ?item wdt:P935 ?wpcommons. }}
               SERVICE wikibase:label {{ bd:serviceParam wikibase:language "[AUTO_LANGUAGE],en". }}
             }}
-            """.format(wdid, wdid, wdid, wdid, wdid)
+            """.format(values)
     base = "https://query.wikidata.org/bigdata/namespace/wdq/sparql"
-    headers = { 'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_11_5) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/50.0.2661.102 Safari/537.36'}
-    query = requests.post(base, headers=headers, params={'query': sparql, 'format': 'json'})
+    with request_gate:
+        rateLimit()
+        query = SESSION.post(base, params={'query': sparql, 'format': 'json'})
     #store and return the request information and data in a dict
     request = {}
-    request['request_id'] = request_id
+    request['request_ids'] = request_ids
     request['sparql_query'] = sparql
     request['status_code'] = query.status_code
     if query.status_code == 200:
@@ -158,12 +234,26 @@ def getWikidataBySpecies(request_id):
         request['data'] = None
     return request
 
-def parseWikidataBySpecies(response):
-    """Parse the wikidata response and put it into a more readable dict"""
+def groupWikidataByItem(response):
+    """Group the bindings in a batched response by the Wikidata id of their ?item"""
+    grouped = {}
+    for b in response['data']['results']['bindings']:
+        wd_id = b['item']['value'].rsplit('/', 1)[-1]
+        if wd_id in grouped:
+            grouped[wd_id].append(b)
+        else:
+            grouped[wd_id] = [b]
+    return grouped
+
+def parseWikidataBySpecies(bindings):
+    """Parse the wikidata bindings for a single species and put them into a more readable dict"""
     results = {}
     #add results from each binding to list for each property, then dedupe each list before returning value
-    for b in response['data']['results']['bindings']:
+    for b in bindings:
         for k, v in b.items():
+            #skip the ?item binding--it's the species id we grouped on, not a property
+            if k == 'item':
+                continue
             if k in results:
                 results[k].append(v['value'])
             else:
@@ -204,37 +294,37 @@ def reshapeWikidata(tree_species):
 
 def writeSpeciesToCsv(tree_species):
     """Write the data out to a csv file suitable for import into a database"""
-    c = open('tree_species.csv', 'w')
     fieldnames = ['Species', 'Common names', 'Images', 'Wikipedia', 'Wikimedia Commons', 'iNaturalist']
-    writer = csv.DictWriter(c, fieldnames=fieldnames)
-    writer.writeheader()
-    for ts in tree_species:
-        row = {}
-        row['Species'] = ts['name']
-        if 'common_names' in ts:
-            row['Common names'] = ', '.join(ts['common_names'])
-        if 'inaturalist' in ts:
-            row['Images'] = ts['inaturalist'] + '/browse_photos'
-        if 'wikipedia' in ts:
-            row['Wikipedia'] = ts['wikipedia']
-        if 'wp_commons' in ts:
-            row['Wikimedia Commons'] = ts['wp_commons']
-        if 'inaturalist' in ts:
-            row['iNaturalist'] = ts['inaturalist']
-        writer.writerow(row)
-    c.close()
-
-#query wikidata for each species (using a respectable rate limit).
+    with open('tree_species.csv', 'w', newline='', buffering=1<<20, encoding='utf-8') as c:
+        writer = csv.writer(c)
+        writer.writerow(fieldnames)
+        #build each row as a list in field order--no per-row dict or per-field default lookups
+        writer.writerows(
+            [ts['name'],
+             ', '.join(ts.get('common_names', [])),
+             ts['inaturalist'] + '/browse_photos' if 'inaturalist' in ts else '',
+             ts.get('wikipedia', ''),
+             ts.get('wp_commons', ''),
+             ts.get('inaturalist', '')]
+            for ts in tree_species)
+
+#query wikidata for all species in batches of 50 ids per request (using a respectable rate limit)
+wd_ids = [ts['wikidata'] for ts in tree_species if 'wikidata' in ts]
+wd_bindings = {}
+#overlap the batched queries on a few threads--rateLimit() keeps the request rate in check
+with ThreadPoolExecutor(max_workers=4) as ex:
+    for wd in ex.map(getWikidataBySpeciesBatch, chunkList(wd_ids, 50)):
+        if wd['data'] is not None:
+            wd_bindings.update(groupWikidataByItem(wd))
+
+#store each species' share of the batched results on its tree species entry
 for ts in tree_species:
-    if 'wikidata' in ts:
-        wd = getWikidataBySpecies(ts['wikidata'])
-        ts['raw_wd'] = wd
-        time.sleep(1)
+    if 'wikidata' in ts and ts['wikidata'] in wd_bindings:
+        ts['raw_wd'] = wd_bindings[ts['wikidata']]
 
-#saving as we go        
-f = open('tree_species.json', 'w')
-json.dump(tree_species, f)
-f.close()
+#saving as we go
+with open('tree_species.json', 'wb') as f:
+    f.write(orjson.dumps(tree_species, option=orjson.OPT_INDENT_2))
 
 
 # Reshape the raw Wikidata results into a more structured form
@@ -277,17 +367,24 @@ addtl_names = [{'wikidata': 'Q1328685', 'alt_species': 'Ilex crenata convexa'},
 {'wikidata': 'Q161374', 'alt_species': 'Platanus acerifolia'},
 {'wikidata': 'Q470006', 'common_name': 'Hackberry'}]
 
+#index the species by wikidata id once so each patch below is a dict lookup instead of a full scan
+by_wd = {}
+for t in tree_species:
+    if 'wikidata' in t:
+        if t['wikidata'] in by_wd:
+            by_wd[t['wikidata']].append(t)
+        else:
+            by_wd[t['wikidata']] = [t]
+
 for a in addtl_names:
-    for t in tree_species:
-        if 'wikidata' in t:
-            if a['wikidata'] == t['wikidata']:
-                if 'common_name' in a:
-                    if 'common_names' in t:
-                        t['common_names'].append(a['common_name'])
-                    else:
-                        t['common_names'] = [a['common_name']]
-                elif 'alt_species' in a:
-                    t['alt_species'] = [a['alt_species']]
+    for t in by_wd.get(a['wikidata'], []):
+        if 'common_name' in a:
+            if 'common_names' in t:
+                t['common_names'].append(a['common_name'])
+            else:
+                t['common_names'] = [a['common_name']]
+        elif 'alt_species' in a:
+            t['alt_species'] = [a['alt_species']]
 
 
 # Some names from Wikidata are duplicated across species and will result in associating the wrong tree with a name.
@@ -302,23 +399,21 @@ remove_name = [{'wikidata': 'Q1988747', 'common_name': 'White pine'},
 {'wikidata': 'Q158987', 'species': 'Prunus salicifolia'},
 {'wikidata': 'Q147498', 'species': 'Ulmus glabra'}]
 
-entity_remove = []
-for i, ts in enumerate(tree_species):
-    for r in remove_name:
-        if 'wikidata' in ts:
-            if ts['wikidata'] == r['wikidata']:
-                if 'common_name' in r:
-                    ts['common_names'] = [c for c in ts['common_names'] if c != r['common_name']]
-                if 'species'in r:
-                    if r['species'] == ts['name']:
-                        entity_remove.append(i)
-tree_species = [ts for i, ts in enumerate(tree_species) if i not in entity_remove]
+entity_remove = set()
+for r in remove_name:
+    for ts in by_wd.get(r['wikidata'], []):
+        if 'common_name' in r:
+            ts['common_names'] = [c for c in ts['common_names'] if c != r['common_name']]
+        if 'species'in r:
+            if r['species'] == ts['name']:
+                entity_remove.add(id(ts))
+tree_species = [ts for ts in tree_species if id(ts) not in entity_remove]
 
 
 # ## Extract species from Tree Trails text
 
 # ### Create the data matching rules
-# Make a SpaCy patterns.jsonl file from the tree species data with all possible variations on the text strings we want to extract from the book text--singular or plural common names, full or abbreviated species names.
+# Make a patterns.jsonl file from the tree species data with all possible variations on the text strings we want to extract from the book text--singular or plural common names, full or abbreviated species names. Because every variation is a literal phrase (no part-of-speech or morphology features), each one is just a string ready to load into the keyword trie below.
 
 def pluralize(text):
     """Get the plural form of a singular noun"""
@@ -330,83 +425,28 @@ def pluralize(text):
         text = text + 's'
     return text
 
-def tokenHyphen(text):
-    """Tokenize hyphenated words into SpaCy patterns"""
-    tokens = text.split('-')
-    patterns = []
-    pattern1 = {}
-    pattern1['LOWER'] = tokens[0].lower()
-    patterns.append(pattern1)
-    hyphen = {}
-    hyphen['ORTH'] = '-'
-    patterns.append(hyphen)
-    pattern2 = {}
-    pattern2['LOWER'] = tokens[1].lower()
-    patterns.append(pattern2)
-    return patterns
-
 def constructTerm(term, label, id):
-    """Create all the patterns needed for matching any variations on a tree species name"""
+    """Create all the phrase variants needed for matching any variations on a tree species name.
+    Matching is done on lowercased tokens, so the variants don't need to worry about case."""
+    if term == '':
+        return None
+    #split the term once up front--both variant builders below need the same tokens
+    tokens = term.split(' ')
     termlist = []
-    if term != '': 
-        listitem = {}
-        listitem['label'] = label
-        listitem['id'] = id
-        patterns = []
     #for labels that are tree species or alternate names for tree species
     if label in ['TREE SPECIES', 'ALT TREE SPECIES']:
-        for s in term.split(' '):
-            pattern = {}
-            #we will lowercase all words in the text and in patterns so we don't have to worry abut case matching
-            pattern['LOWER'] = s.lower()
-            patterns.append(pattern)
-        listitem['pattern'] = patterns
-        termlist.append(listitem.copy())
-        #create a pattern with genus abbreviated, ex. "p. strobus"
-        altitem = {}
-        altitem['label'] = label
-        altitem['id'] = id
-        altpatterns = []
-        for i, s in enumerate(term.split(' ')):
-            altpattern = {}
-            if i == 0:
-                altpattern['LOWER'] = s[0].lower() + '.'
-                altpatterns.append(altpattern)
-            else:
-                altpattern['LOWER'] = s.lower()
-                altpatterns.append(altpattern)
-        altitem['pattern'] = altpatterns
-        termlist.append(altitem.copy())
-    #for the labels that are common names, add patterns for matching pluralized form in addition to singular 
+        termlist.append({'label': label, 'id': id, 'pattern': term})
+        #create a variant with the genus abbreviated, ex. "p. strobus"
+        abbreviated = ' '.join([tokens[0][0] + '.'] + tokens[1:])
+        termlist.append({'label': label, 'id': id, 'pattern': abbreviated})
+    #for the labels that are common names, add a variant for matching the pluralized form in addition to singular
     elif label == 'TREE COMMON NAME':
-        for i, s in enumerate(term.split(' ')):
-            if '-' in s:
-                hyphenpatterns = tokenHyphen(s)
-                patterns.extend(hyphenpatterns)
-            else:
-                pattern = {}
-                pattern['LOWER'] = s.lower()
-                patterns.append(pattern)
-        listitem['pattern'] = patterns
-        termlist.append(listitem.copy())
-        patterns = []
-        for i, s in enumerate(term.split()):
-            pattern = {}
-            #pluralize only the last token in the word
-            if i != len(term.split())-1:
-                if '-' in s:
-                    hyphenpatterns = tokenHyphen(s)
-                    patterns.extend(hyphenpatterns)
-                else:
-                    pattern['LOWER'] = s.lower()
-                    patterns.append(pattern)
-            else:
-                pattern['LOWER'] = pluralize(s.lower())
-                patterns.append(pattern)
-        listitem['pattern'] = patterns
-        termlist.append(listitem)
+        termlist.append({'label': label, 'id': id, 'pattern': term})
+        #pluralize only the last word in the name
+        plural = ' '.join(tokens[:-1] + [pluralize(tokens[-1])])
+        termlist.append({'label': label, 'id': id, 'pattern': plural})
     else:
-        listitem = None
+        termlist = None
     return termlist
 
 #create patterns file while also adding ids to tree species objects. If a Wikidata id doesn't exist, add an 
@@ -439,23 +479,21 @@ for t in tree_species:
     if 'wikidata' not in t:
         alt_id += 1
 
-ts_out = open('tree_species.json', 'w')
-json.dump(tree_species, ts_out)
-ts_out.close()
+with open('tree_species.json', 'wb') as ts_out:
+    ts_out.write(orjson.dumps(tree_species, option=orjson.OPT_INDENT_2))
 
-#save the patterns for SpaCy as a new-line delimited json file (.jsonl)
+#save the patterns as a new-line delimited json file (.jsonl), overwriting any stale
+#patterns from a previous run--appending here would silently bloat the file across reruns
 termlistname = 'patterns.jsonl'
-f = open(termlistname, 'a')
-writer = jsonlines.Writer(f)
-writer.write_all(termlist)
-writer.close()
-f.close()
+with open(termlistname, 'wb') as f:
+    f.write(b'\n'.join(orjson.dumps(t) for t in termlist))
+    f.write(b'\n')
 
 
 # ### Get the Tree Trails book text
 # The full text of Tree Trails is provided by the publisher at https://www.echonyc.com/~parks/books/treetrailsppk.html. We will scrape the html from that page and convert it to plain text with the Python lxml library.
 
-query = requests.get('https://www.echonyc.com/~parks/books/treetrailsppk.html')
+query = SESSION.get('https://www.echonyc.com/~parks/books/treetrailsppk.html')
 
 #convert html to plain text
 parser = et.HTMLParser()
@@ -473,48 +511,85 @@ typos = [{'find': 'Comus florida', 'replace':'Cornus florida'},
         {'find': 'P. onentalis', 'replace': 'P. orientalis'},
         {'find': 'P. strobits', 'replace': 'P. strobus'}]
 
-for t in typos:
-    text = text.replace(t['find'], t['replace'])
+#fix all the typos in one pass over the text instead of one full scan (and string copy) per
+#typo. Sorting longest-first keeps longest-match semantics if one typo is a prefix of another.
+typo_repl = {t['find']: t['replace'] for t in typos}
+typo_re = re.compile('|'.join(re.escape(f) for f in sorted(typo_repl, key=len, reverse=True)))
+text = typo_re.sub(lambda m: typo_repl[m.group(0)], text)
 
 
 # ### Locate species in text
-# This step uses Spacy's [EntityRuler](https://spacy.io/usage/rule-based-matching#entityruler) for rule-based matching on the patterns we created above in the patterns.jsonl file. In this NLP pipeline, we will also identify sentences, so we can group them into paragraphs.
+# This step uses [flashtext](https://github.com/vi3k6i5/flashtext)'s KeywordProcessor--an Aho-Corasick-style keyword trie--to find our phrase variants in the book text. Because all of the variants are literal strings, extraction time scales with the length of the text rather than the number of patterns, so adding more species is essentially free. SpaCy stays in the pipeline only to identify sentences, so we can group them into paragraphs.
 
-#create a blank SpaCy pipeline
+#create a blank SpaCy pipeline with a pipe to identify the sentences in the text
 nlp = spacy.blank('en')
-#create an instance of the EntityRuler to add to our pipeline below
-ruler = EntityRuler(nlp)
-#load the custom vocabs from the appropriate patterns.jsonl
-patternfile = 'patterns.jsonl'
-ruler.from_disk(patternfile)
-#add a pipe in our nlp pipeline to identify the sentences in the text
-nlp.add_pipe(nlp.create_pipe('sentencizer'))
-#add a pipe in our nlp pipeline for the EntityRuler to match our patterns
-nlp.add_pipe(ruler)
-
-#run the text through the nlp pipeline
-doc = nlp(text)
-
-#get entity information from the nlp process. save entities, ids, and character offsets for later use
-ents = []
-for e in doc.ents:
-    ent = {}
-    ent['text'] = e.text
-    ent['start_char'] = e.start_char
-    ent['end_char'] = e.end_char
-    ent['id'] = e.ent_id_
-    ent['spacy_id'] = e.ent_id
-    ent['label'] = e.label_
-    ents.append(ent)
-
-#save sentences and their character offsets in a list
-sents = []
-for s in doc.sents:
-    sent = {}
-    sent['text'] = s.text
-    sent['start_char'] = s.start_char
-    sent['end_char'] = s.end_char
-    sents.append(sent)
+nlp.add_pipe('sentencizer')
+
+#load every phrase variant into a case-insensitive keyword trie, mapping each one back
+#to its label and species id
+kp = KeywordProcessor(case_sensitive=False)
+for t in termlist:
+    kp.add_keyword(t['pattern'], (t['label'], t['id']))
+
+#split the text into paragraph-sized chunks so the sentencizer can process them as a batched
+#stream instead of one giant doc. The lookahead split keeps each '\n\n' delimiter attached to
+#the chunk that follows it (the paragraph grouping below depends on those). Sentences never
+#span a chunk boundary, so an unpunctuated heading like 'TOUR I' ends at its boundary and
+#becomes its own sentence instead of merging into the following paragraph's first sentence
+chunk_re = re.compile(r'(?<!\n)(?=\n\n)')
+text_chunks = [c for c in chunk_re.split(text) if c != '']
+
+#track each chunk's offset so sentence offsets can be mapped back to the full text
+chunk_offsets = []
+offset = 0
+for c in text_chunks:
+    chunk_offsets.append(offset)
+    offset += len(c)
+
+#run the chunks through the nlp pipeline to get sentences, in parallel across cores. The book
+#text only changes when the typo fixes above do, so cache the processed docs on disk keyed by a
+#hash of the text--reruns skip tokenizing and sentencizing the whole book and just read the
+#DocBin back
+cache_path = Path('.cache') / (hashlib.sha1(text.encode('utf-8')).hexdigest() + '.spacy')
+docs = None
+if cache_path.exists():
+    docs = list(DocBin().from_disk(cache_path).get_docs(nlp.vocab))
+    #the cache is keyed on the text alone, so an edit to chunk_re would leave a stale doc list
+    #that silently misaligns with chunk_offsets--treat a length mismatch as a cache miss
+    if len(docs) != len(text_chunks):
+        docs = None
+if docs is None:
+    docs = list(nlp.pipe(text_chunks, n_process=-1, batch_size=32))
+    cache_path.parent.mkdir(exist_ok=True)
+    DocBin(attrs=['ORTH', 'SENT_START'], store_user_data=True, docs=docs).to_disk(cache_path)
+
+#extract the keywords (flashtext keeps the longest match wherever variants overlap) and save
+#them as parallel arrays--numpy int64 offsets plus plain lists--instead of one dict per entity.
+#flashtext scans the text left to right, so the offsets come back already sorted
+keywords = kp.extract_keywords(text, span_info=True)
+ent_start = np.fromiter((start for _, start, _ in keywords), dtype=np.int64, count=len(keywords))
+ent_end = np.fromiter((end for _, _, end in keywords), dtype=np.int64, count=len(keywords))
+ent_label = [label for (label, _), _, _ in keywords]
+ent_id = [wd_id for (_, wd_id), _, _ in keywords]
+ent_text = [text[start:end] for _, start, end in keywords]
+
+def entRecord(j):
+    """Materialize a single entity record from the parallel entity arrays"""
+    return {'text': ent_text[j], 'start_char': int(ent_start[j]), 'end_char': int(ent_end[j]),
+            'id': ent_id[j], 'label': ent_label[j]}
+
+#save sentence texts and offsets in parallel arrays as well, adding each chunk's base offset
+#so the offsets are relative to the full text
+sent_texts = []
+sent_start = []
+sent_end = []
+for base, doc in zip(chunk_offsets, docs):
+    for s in doc.sents:
+        sent_texts.append(s.text)
+        sent_start.append(base + s.start_char)
+        sent_end.append(base + s.end_char)
+sent_start = np.array(sent_start, dtype=np.int64)
+sent_end = np.array(sent_end, dtype=np.int64)
 
 
 # ## Split text and tree data by paragraph
@@ -522,15 +597,15 @@ for s in doc.sents:
 
 #first, split text by the word "TOUR" and "FOOTNOTE". The first segment will be front matter/introduction and the 
 #last segment will be back matter. Everything in between is a tour.
+#sections hold runs of sentence indexes into the parallel sentence arrays
 sections = []
 section = []
-for s in sents:
-    if ('TOUR' not in s['text']) and ('FOOTNOTE' not in s['text']):
-        section.append(s)
+for i, stext in enumerate(sent_texts):
+    if ('TOUR' not in stext) and ('FOOTNOTE' not in stext):
+        section.append(i)
     else:
         sections.append(section)
-        section = []
-        section.append(s)
+        section = [i]
 sections.append(section)
 
 #assign tour names to relevant sections
@@ -551,100 +626,109 @@ tours['back_matter']['sents'] = sections[5]
 
 # For each tour section, break into paragraphs based on "\n\n"
 
-#split each section into paragraphs based on '\n\n' and add to tours dict
-for k, t in tours.items():
+def makePara(idx):
+    """Build a paragraph record--its sentence texts plus start and end char offsets--from a
+    run of sentence indexes"""
+    return {'sent_texts': [sent_texts[i] for i in idx],
+            'start_char': int(sent_start[idx[0]]),
+            'end_char': int(sent_end[idx[-1]])}
+
+#split each section into paragraphs based on '\n\n' and add to tours dict. Accumulate the
+#sentence indexes in a plain list and only build the paragraph record when flushing
+for t in tours.values():
     t['paragraphs'] = []
-    p = {}
-    p['sents'] = []
-    for s in t['sents']:
-        if not(re.match(r'\n\n', s['text'])):
-            p['sents'].append(s)
+    cur = []
+    for i in t['sents']:
+        #a plain prefix check--no need to pay for the regex engine on every sentence
+        if not sent_texts[i].startswith('\n\n'):
+            cur.append(i)
         else:
-            if len(p['sents']) > 0:
-                t['paragraphs'].append(p.copy())
-            p = {}
-            p['sents'] = []
-            p['sents'].append(s)
-    t['paragraphs'].append(p)
-    #add start and end char offsets for each paragraph
-    for p in t['paragraphs']:
-        p['start_char'] = p['sents'][0]['start_char']
-        p['end_char'] = p['sents'][-1]['end_char']
+            if len(cur) > 0:
+                t['paragraphs'].append(makePara(cur))
+            cur = [i]
+    if len(cur) > 0:
+        t['paragraphs'].append(makePara(cur))
 
 
 # For each paragraph, find the corresponding entities (in tours only) by checking entity character offsets that fall within the paragraph character offsets.
 
-#find entities within each paragraph by checking if each entity's starting character offset is within the paragraph offsets
+#find entities within each paragraph by checking which entities' starting character offsets fall
+#within the paragraph offsets. The entity offsets are already sorted, so each paragraph is a
+#binary search yielding a slice [ent_lo, ent_hi) into the entity arrays
 for k, t, in tours.items():
     #only find entities in the tours, not the introduction or back matter
     if k not in ['intro', 'back_matter']:
         for p in t['paragraphs']:
-            p['ents'] = []
-            for e in ents:
-                if e['start_char'] in range(p['start_char'], p['end_char']):
-                    p['ents'].append(e)
+            p['ent_lo'] = int(np.searchsorted(ent_start, p['start_char'], side='left'))
+            p['ent_hi'] = int(np.searchsorted(ent_start, p['end_char'], side='left'))
 
 
 # There might be multiple mentions of a species or its common name within a paragraph, so we'll assume they're talking about the same tree and group them. For some common names, if a species isn't reference in a paragraph, we will look it up in the tree_species list and add group it with the common name.
 
-def getCommonBySpeciesId(id, tree_species):
-    common_names = []
-    for ts in tree_species:
-        if (ts['id'] == ent['id']):
-            #check if the matched tree species has common names
-            if 'common_names' in ts:
-                for cn in ts['common_names']:
-                    common_names.append(cn)
-    return common_names
+#index the species by id once, and precompute the normalized (title-cased) singular and plural
+#forms of each species' common names, so the merge loop below does a single set lookup instead
+#of re-normalizing every common name for every entity pair
+ts_by_id = {ts['id']: ts for ts in tree_species}
+for ts in tree_species:
+    norms = set()
+    if 'common_names' in ts:
+        for c in ts['common_names']:
+            titled = c.title().replace("'S", "'s")
+            norms.add(titled)
+            norms.add(pluralize(titled))
+    ts['_cn_norm'] = frozenset(norms)
 
 #merge entities with same id within each paragraph, including common names that match tree species in the paragraph and ignoring single common names with no corresponding species
-for k, t, in tours.items():
+for t in tours.values():
     for p in t['paragraphs']:
         p['merged_ents'] = {}
-        if 'ents' in p:
-            for e in p['ents']:
-              #first add the species
-              if e['label'] == 'TREE SPECIES':
-                if e['id'] not in p['merged_ents']:
-                    p['merged_ents'][e['id']] = [e]
-                else:
-                    p['merged_ents'][e['id']].append(e)
-            for e in p['ents']:
+        if 'ent_lo' in p:
+            lo = p['ent_lo']
+            hi = p['ent_hi']
+            #first add the species--the label/id checks read the parallel arrays directly and a
+            #record dict is only materialized for entities that actually get merged
+            for j in range(lo, hi):
+                if ent_label[j] == 'TREE SPECIES':
+                    if ent_id[j] not in p['merged_ents']:
+                        p['merged_ents'][ent_id[j]] = [entRecord(j)]
+                    else:
+                        p['merged_ents'][ent_id[j]].append(entRecord(j))
+            for j in range(lo, hi):
               #only include single-token names if they have a corresponding species (single-token name might be too general to be an accurate match)
-              if e['label'] == 'TREE COMMON NAME':
-                if ' ' not in e['text']:
-                    if e['id'] in p['merged_ents']:
-                        p['merged_ents'][e['id']].append(e)
+              if ent_label[j] == 'TREE COMMON NAME':
+                e_id = ent_id[j]
+                e_text = ent_text[j]
+                if ' ' not in e_text:
+                    if e_id in p['merged_ents']:
+                        p['merged_ents'][e_id].append(entRecord(j))
                 #if multi-token names have a corresponding species, add to that list
-                elif e['id'] in p['merged_ents']:
-                    p['merged_ents'][e['id']].append(e)
+                elif e_id in p['merged_ents']:
+                    p['merged_ents'][e_id].append(entRecord(j))
                 else:
-                    #if not, then check the common name against common names of other species in the paragraph and
-                    #get the list of entity ids in the paragraph
-                    common = {}
-                    #iterate through each id
-                    for ent in p['ents']:
-                        if ent['label'] == 'TREE SPECIES':
+                    #if not, then check the common name against common names of other species in the paragraph
+                    common = []
+                    #title case the name once--the normalized singular and plural forms are precomputed per species
+                    e_norm = e_text.title().replace("'S", "'s")
+                    #iterate through each species entity in the paragraph
+                    for jj in range(lo, hi):
+                        if ent_label[jj] == 'TREE SPECIES':
                             if len(common) == 0:
-                                cn = getCommonBySpeciesId(ent['id'], tree_species)
-                                for c in cn:
-                                    #title case the name and check if it matches the singular or plural form of the common name
-                                    if e['text'].title().replace("'S", "'s") in [pluralize(c.title().replace("'S", "'s")), c.title().replace("'S", "'s")]:
-                                        #if so, add it and its tree species to the list
-                                        common = [{'text':e['text'], 'label':'TREE COMMON NAME', 'id':ent['id'], 'start_char':e['start_char']},
-                                                  {'text':ent['label'], 'label':'TREE SPECIES', 'id':ent['id']}]
-                                        if ent['id'] in p['merged_ents']:
-                                            p['merged_ents'][ent['id']].extend(common)
-                                        else:
-                                            p['merged_ents'][ent['id']] = common
-                    #otherwise, check the common names of species in the paragraph against tree_species
+                                if e_norm in ts_by_id[ent_id[jj]]['_cn_norm']:
+                                    #if it matches, add it and its tree species to the list
+                                    common = [{'text':e_text, 'label':'TREE COMMON NAME', 'id':ent_id[jj], 'start_char':int(ent_start[j])},
+                                              {'text':ent_label[jj], 'label':'TREE SPECIES', 'id':ent_id[jj]}]
+                                    if ent_id[jj] in p['merged_ents']:
+                                        p['merged_ents'][ent_id[jj]].extend(common)
+                                    else:
+                                        p['merged_ents'][ent_id[jj]] = common
+                    #otherwise, look the common name's own species up in the index
                     if len(common) == 0:
-                        species = {}
-                        for ts in tree_species:
-                            if e['id'] == ts['id']:
-                                species = [{'text':ts['name'], 'label':'TREE SPECIES', 'id':e['id']},
-                                           {'text':e['text'], 'label':'TREE COMMON NAME', 'id':e['id'], 'start_char':e['start_char']}]
-                        p['merged_ents'][e['id']] = species
+                        species = []
+                        ts = ts_by_id.get(e_id)
+                        if ts is not None:
+                            species = [{'text':ts['name'], 'label':'TREE SPECIES', 'id':e_id},
+                                       {'text':e_text, 'label':'TREE COMMON NAME', 'id':e_id, 'start_char':int(ent_start[j])}]
+                        p['merged_ents'][e_id] = species
 
 
 # ### Generate tour "stops" with title, lead-in, rich text book excerpt, tour number, and id to use for linking to tree species list
@@ -654,41 +738,49 @@ for k, t, in tours.items():
 
 formatting = 'memento'
 
-def bold(text, formatting='memento'):
-    if formatting == 'memento':
-        text = '<b>' + text + '</b>'
-    return text
-
-def italic(text, rgb='156, 39, 176', formatting='memento'):
-    if formatting == 'memento':   
-        if rgb is not None:
-            color = 'style="color: rgb({});"'.format(rgb)
-            text = '<i {}>'.format(color) + text + '</i>'
-        else:
-            text = '<i>' + text + '</i>'
-    return text
+#pick the name-wrapping functions once up front instead of re-branching on the formatting
+#value (and rebuilding the same color style string) for every wrapped name
+if formatting == 'memento':
+    def wrapSpecies(text):
+        """Wrap a species name in bold italic rich text"""
+        return f'<b><i style="color: rgb(156, 39, 176);">{text}</i></b>'
+    def wrapCommon(text):
+        """Wrap a common name in italic rich text"""
+        return f'<i style="color: rgb(156, 39, 176);">{text}</i>'
+else:
+    #Airtable doesn't support rich text imported through CSV, so leave the names as they are
+    def wrapSpecies(text):
+        return text
+    def wrapCommon(text):
+        return text
+
+#compile the formatting regexes once--these functions run once per paragraph, so there's no
+#need to rebuild the patterns on every call
+LBS_RE = re.compile('\xa0')
+STOPSTART_RE = re.compile('^\n+')
+LB_RE = re.compile('\n\n+')
+SPACING_RE = re.compile(' +')
 
 def lineBreaks(text, formatting='memento'):
     """Format line breaks consistently"""
-    #strip line breaks at the start of a stop
-    lbs = re.compile('\xa0')
-    text = re.sub(lbs, '', text)
-    stopstart = re.compile('^\n+')
-    text = re.sub(stopstart, '', text)
-    #replace excessive linebreaks with double line break
-    lb = re.compile('\n\n+')
-    text = re.sub(lb, '\n\n', text)
-    return text
-
-def joinSents(sents):
-    """Join sentences with consistent spacing"""
-    text = ' '.join([s['text'] for s in sents])
-    spacing = re.compile(' +')
-    text = re.sub(spacing, ' ', text)
-    return text
-
-def createTitle(merged_ent):
-    """Make the title the common name followed by the species in parentheses, or just the species, if the common name 
+    #strip non-breaking spaces and line breaks at the start of a stop, then replace excessive
+    #linebreaks with double line break
+    return LB_RE.sub('\n\n', STOPSTART_RE.sub('', LBS_RE.sub('', text)))
+
+def joinSents(texts):
+    """Join sentence texts with consistent spacing"""
+    return SPACING_RE.sub(' ', ' '.join(texts))
+
+def cutText(text, sentinel):
+    """Split text at the first occurrence of sentinel, returning the text before and after it.
+    If the sentinel isn't present, return the whole text and None"""
+    i = text.find(sentinel)
+    if i < 0:
+        return text, None
+    return text[:i], text[i + len(sentinel):]
+
+def createTitle(merged_ent, ts_by_id):
+    """Make the title the common name followed by the species in parentheses, or just the species, if the common name
     doesn't appear in the paragraph"""
     species = None
     commons = []
@@ -696,14 +788,16 @@ def createTitle(merged_ent):
         #add any common names to a list
         if m['label'] == 'TREE COMMON NAME':
             commons.append(m['text'])
-        #get full tree species name
-        for ts in tree_species:
-            if m['id'] == ts['id']:
-                species = ts['name']
-    commons = list(set(commons))  
-    if len(commons) > 0:
+        #get full tree species name from the id index
+        ts = ts_by_id.get(m['id'])
+        if ts is not None:
+            species = ts['name']
+    #dedupe the common names while keeping the order they appear in the paragraph, so "the
+    #first common name" really is the first one encountered (set order is unspecified)
+    first = next(iter(dict.fromkeys(commons)), None)
+    if first is not None:
         #use the first common name in the common name list as the title
-        title = commons[0].capitalize()
+        title = first.capitalize()
         #add the species in parentheses after the common name
         if species is not None:
             title = title + ' (' + species.capitalize() + ')'
@@ -713,80 +807,87 @@ def createTitle(merged_ent):
 
 def createExcerpt(paragraph, merged_ent):
     """Convert paragraphs into rich text, bolding and/or italicizing tree names"""
-    #get unique entities and labels
-    u_ents = {}
+    #get the unique species and common name strings in the paragraph
+    species_terms = set()
+    common_terms = set()
     for m in merged_ent:
-        if m['label'] in u_ents:
-            if m['text'] not in u_ents[m['label']]:
-                u_ents[m['label']].append(m['text'])
-        else:
-            u_ents[m['label']] = [m['text']]
-    p_text = joinSents(paragraph['sents'])
-    #join sentences
-    excerpt = lineBreaks(p_text, formatting=formatting)
-    for k, u in u_ents.items():
-        if k in ['TREE SPECIES', 'ALT TREE SPECIES']:
-            for text in u:
-                excerpt = excerpt.replace(text, bold(italic(text, formatting=formatting), formatting=formatting))
-        if k == 'TREE COMMON NAME':
-            for text in u:
-                excerpt = excerpt.replace(text, italic(text, formatting=formatting))
+        if m['label'] in ['TREE SPECIES', 'ALT TREE SPECIES']:
+            species_terms.add(m['text'])
+        elif m['label'] == 'TREE COMMON NAME':
+            common_terms.add(m['text'])
+    #the paragraph text was joined once up front
+    excerpt = lineBreaks(paragraph['_joined'], formatting=formatting)
+    #wrap every name in one pass with a single alternation pattern instead of a full-string
+    #replace per name. Longest terms first, so a short name can't shadow a longer one it prefixes
+    terms = sorted(species_terms | common_terms, key=len, reverse=True)
+    if len(terms) > 0:
+        pat = re.compile('|'.join(re.escape(t) for t in terms))
+        excerpt = pat.sub(lambda m: wrapSpecies(m.group(0))
+                          if m.group(0) in species_terms
+                          else wrapCommon(m.group(0)), excerpt)
     return excerpt
 
-def getSpecies(merged_ent, tree_species):
+def getSpecies(merged_ent, ts_by_id):
     """Get the tree species name for an entity"""
     species = None
     for m in merged_ent:
         if m['label'] == 'TREE SPECIES':
-            for ts in tree_species:
-                if m['id'] == ts['id']:
-                    species = ts['name']
+            ts = ts_by_id.get(m['id'])
+            if ts is not None:
+                species = ts['name']
     return species
 
 def createLeadIn(p):
     """Use the first 35 characters as a lead-in field to use in the card description"""
-    leadin = p['sents'][0]['text'].replace('\n', ' ').strip()[0:35] + '...'
-    return leadin
+    #only the first 35 characters survive, so slice before cleaning up rather than copying the
+    #whole first sentence--128 leaves plenty of headroom for whitespace absorbed by the strip
+    head = p['sent_texts'][0][:128].replace('\n', ' ').strip()
+    return head[0:35] + '...'
 
-def createStop(paragraph, merged_ent, id, tree_species):
+def createStop(paragraph, merged_ent, id, ts_by_id):
     """Create all the database fields for a tour stop for each merged entity in a paragraph"""
     stop = {}
-    stop['title'] = createTitle(merged_ent)
+    stop['title'] = createTitle(merged_ent, ts_by_id)
     stop['lead-in'] = createLeadIn(paragraph)
     stop['excerpt'] = createExcerpt(paragraph, merged_ent)
-    stop['species'] = getSpecies(merged_ent, tree_species)
+    stop['species'] = getSpecies(merged_ent, ts_by_id)
     return stop
 
-def appendNoEntPara(stops, p):
-    """If there are no entities in a paragraph, append it to the previous stop (or stops if the last para was
+#index of the first stop in the current run of stops sharing a lead-in (a paragraph repeated
+#as a stop for each of its tree species). Tracking it as stops are appended means
+#appendNoEntPara can extend the whole run as a slice instead of rescanning backwards
+run_start = 0
+
+def appendStop(stops, stop):
+    """Append a stop, tracking where the current run of stops with the same lead-in begins"""
+    global run_start
+    if len(stops) == 0 or stops[-1]['lead-in'] != stop['lead-in']:
+        run_start = len(stops)
+    stops.append(stop)
+
+def appendNoEntPara(stops, p_text):
+    """If there are no entities in a paragraph, append its text to the previous stop (or stops if the last para was
     broken up into multiple stops)"""
-    prev_stop = -2
-    p_text = '\n\n' + joinSents(p['sents'])
-    stops[-1]['excerpt'] = lineBreaks(stops[-1]['excerpt'] + p_text, formatting=formatting)
-    #append it to all previous stops with the same lead-in, for previous paragraphs repeated for multiple entities
-    if len(stops) > 1:
-        while stops[prev_stop]['lead-in'] ==  stops[-1]['lead-in']:
-            #re-run it through lineBreaks() after adding to remove any errant formatting
-            stops[prev_stop]['excerpt'] = lineBreaks(stops[prev_stop]['excerpt'] + p_text, formatting=formatting)  
-            prev_stop = prev_stop - 1
+    #normalize the paragraph text once, then extend every stop in the current run with it. The
+    #existing excerpts were already normalized when built, so only the seam needs cleaning up
+    cleaned = '\n\n' + lineBreaks(p_text, formatting=formatting)
+    for s in stops[run_start:]:
+        s['excerpt'] = s['excerpt'].rstrip('\n') + cleaned
     return stops
 
 def writeStopsToCsv(stops, out):
     """Write the data out to a csv file suitable for import into the database"""
-    fieldnames = ['Name', 'Description', 'Excerpt', 'Tree species', 'Tour', 'Sequence']
-    writer = csv.DictWriter(out, fieldnames=fieldnames)
-    writer.writeheader()
-    for s in stops:
-        row = {}
-        row['Name'] = s['title']
-        row['Excerpt'] = s['excerpt']
-        row['Description'] = s['lead-in']
-        if 'species' in s:
-            row['Tree species'] = s['species']
-        row['Tour'] = s['tour']
-        row['Sequence'] = s['sequence']
-        writer.writerow(row)
-    out.close()  
+    writer = csv.writer(out)
+    writer.writerow(['Name', 'Description', 'Excerpt', 'Tree species', 'Tour', 'Sequence'])
+    #build each row as a list in field order--no per-row dict or per-field name lookups
+    writer.writerows(
+        [s['title'],
+         s['lead-in'],
+         s['excerpt'],
+         s.get('species', ''),
+         s['tour'],
+         s['sequence']]
+        for s in stops)
 
 
 # ### Create tour "stops" for each merged entity in each paragraph
@@ -794,6 +895,12 @@ def writeStopsToCsv(stops, out):
 
 stops = []
 
+#join each paragraph's sentences once up front--several of the passes below need the joined
+#text, and rebuilding it at every call site repeats the same concatenation and regex work
+for t in tours.values():
+    for p in t['paragraphs']:
+        p['_joined'] = joinSents(p['sent_texts'])
+
 
 # #### Process front matter
 
@@ -802,58 +909,43 @@ for k, t in tours.items():
     #for title page/colophon 
     if k == 'intro':
         fm_p = None
-        #find all front matter before the table of contents and the Marianne Moore poem, which is under a different copyright
+        intro_p = None
+        #find the front matter boundary (the table of contents, before the Marianne Moore poem,
+        #which is under a different copyright) and the "INTRODUCTION" paragraph in a single pass
         for i, p in enumerate(t['paragraphs']):
-            fmp_text = joinSents(p['sents'])
-            if 'TABLE' in fmp_text:
+            if 'TABLE' in p['_joined']:
                 fm_p = i
+            if 'INTRODUCTION' in p['_joined']:
+                intro_p = i
         front_matter_p = t['paragraphs'][0:fm_p]
-        #only use text after the web page header
-        for i, fs in enumerate(front_matter_p):
-            for j, fss in enumerate(fs['sents']):
-                if 'Tree Trails in Prospect Park' in fss['text']:
-                    front_matter_p[i]['sents'][i]['text'] = 'Tree Trails in Prospect Park' + front_matter_p[i]['sents'][i]['text'].split('Tree Trails in Prospect Park')[1]
-        fm_texts = []
-        #join all sentences in the front matter, omitting any text up to and including 'TABLE'
-        for fmp in front_matter_p:
-            fm_text = [s['text'] for s in fmp['sents']]
-            for f in fm_text:
-                if 'TABLE' in f:
-                    f = f.split('TABLE')[0]
-                fm_texts.append(f) 
-        fm = lineBreaks(''.join(fm_texts), formatting=formatting)
+        #feed the join straight from a generator--no intermediate list of short strings. Each
+        #sentence keeps only text after the web page header and before any 'TABLE'
+        fm = lineBreaks(''.join(
+            cutText(f if (cut := cutText(f, 'Tree Trails in Prospect Park'))[1] is None
+                    else 'Tree Trails in Prospect Park' + cut[1], 'TABLE')[0]
+            for fmp in front_matter_p for f in fmp['sent_texts']), formatting=formatting)
         #create the stop for the front_matter
         stop = {}
         stop['title'] = 'Front Matter'
         stop['lead-in'] = fm[0:30] + '...'
         stop['excerpt'] = fm
         stop['tour'] = 'Introduction'
-        stops.append(stop.copy())
-        #get the paragraphs in the introduction, after the poem
-        intro_p = None
-        #find the paragraph with "INTRODUCTION", so we can use all text after that for the intro
-        for i, p in enumerate(t['paragraphs']):
-            p_text = joinSents(p['sents'])
-            if 'INTRODUCTION' in p_text:
-                intro_p = i
+        appendStop(stops, stop)
+        #get the paragraphs in the introduction, after the poem--intro_p was found above along
+        #with the front matter boundary
         intro_paragraphs = t['paragraphs'][intro_p:]
-        texts = []
-        #join all sentences in the intro, omitting any text up to and including 'INTRODUCTION'
-        for p in intro_paragraphs:
-            text = [s['text'] for s in p['sents']]
-            for t in text:
-                if 'INTRODUCTION' in t:
-                    t = t.split('INTRODUCTION')[1]
-                texts.append(t)   
-        #join while cleaning up line breaks and whitespace
-        p_text = lineBreaks(''.join(texts))
+        #join all sentences in the intro from a generator, omitting any text up to and
+        #including 'INTRODUCTION', while cleaning up line breaks and whitespace
+        p_text = lineBreaks(''.join(
+            s if (cut := cutText(s, 'INTRODUCTION'))[1] is None else cut[1]
+            for p in intro_paragraphs for s in p['sent_texts']))
         #create the stops for the intro
         stop = {}
         stop['title'] = 'INTRODUCTION'
         stop['lead-in'] = p_text[0:35] + '...'
         stop['excerpt'] = p_text
         stop['tour'] = 'Introduction'
-        stops.append(stop.copy())
+        appendStop(stops, stop)
 
 
 # #### Process tours
@@ -867,40 +959,38 @@ for k, t in tours.items():
                 p['merged_ents'] = {}
             #if there are no entities in the paragraph, then append the paragraph text to the previous stop excerpt, unless it contains "TOUR"
             if len(p['merged_ents']) == 0:
-                if 'TOUR' not in joinSents(p['sents']):
+                if 'TOUR' not in p['_joined']:
                     if len(stops) > 0:
-                        stops = appendNoEntPara(stops, p)
+                        stops = appendNoEntPara(stops, p['_joined'])
                 else:
                     stop = {}
                     stop['title'] = 'TOUR ' + k            
-                    p_text = joinSents(p['sents'])
                     #if there is other text in this paragraph before the tour name, split it out and append it to the previous stop(s)
-                    if 'TOUR' in p_text:
-                        p_text = 'TOUR' + p_text.split('TOUR')[1]
-                        to_prev = {'sents':[{'text':p_text.split('TOUR')[0]}]}
-                        appendNoEntPara(stops, to_prev)
+                    before, after = cutText(p['_joined'], 'TOUR')
+                    if after is not None:
+                        p_text = 'TOUR' + after
+                        if len(before) > 0:
+                            appendNoEntPara(stops, before)
+                    else:
+                        p_text = p['_joined']
                     stop['lead-in'] = lineBreaks(p_text[0:35] + '...', formatting=formatting)
                     stop['excerpt'] = lineBreaks(p_text, formatting=formatting)
                     stop['tour'] = 'TOUR ' + tour
-                    stops.append(stop.copy())
+                    appendStop(stops, stop)
             #create stop for each merged ent in a paragraph
             else:
                 if 'merged_ents' in p:
-                    #order merged_ents by earliest offsets
-                    merged_ents = []
-                    ordered_ents = []
-                    for k, v in p['merged_ents'].items():
-                        if len(v) > 0:
-                            m_ent = {}
-                            m_ent['id'] = k
-                            m_ent['earliest_start_char'] = min([d['start_char'] for d in v if 'start_char' in d])
-                            m_ent['ents'] = v
-                            merged_ents.append(m_ent)
-                        ordered_ents = sorted(merged_ents, key=lambda k: k['earliest_start_char']) 
+                    #order merged_ents by earliest offsets--build the list in one comprehension
+                    #and sort it once, not once per entity
+                    merged_ents = [{'id': e_id,
+                                    'earliest_start_char': min(d['start_char'] for d in v if 'start_char' in d),
+                                    'ents': v}
+                                   for e_id, v in p['merged_ents'].items() if len(v) > 0]
+                    ordered_ents = sorted(merged_ents, key=lambda m: m['earliest_start_char'])
                     for o in ordered_ents:
-                        stop = createStop(p, o['ents'], o['id'], tree_species)
+                        stop = createStop(p, o['ents'], o['id'], ts_by_id)
                         stop['tour'] = 'TOUR ' + tour
-                        stops.append(stop.copy())
+                        appendStop(stops, stop)
 
 
 # #### Process back matter
@@ -915,23 +1005,22 @@ for k, t in tours.items():
         wordabout = []
         #find the paragraph indexes for each
         for i, p in enumerate(t['paragraphs']):
-            bmp_text = joinSents(p['sents'])
+            bmp_text = p['_joined']
             if 'FOOTNOTE' in bmp_text:
                 fn_p = i
             if 'WORD ABOUT' in bmp_text:
                 wa_p = i
         #split by index and add to separate lists
         for i, p in enumerate(t['paragraphs'][0:wa_p]):
-            fnp_text = ''.join([s['text'] for s in p['sents']])
-            if 'FOOTNOTE' in fnp_text:
+            fnp_text = ''.join(p['sent_texts'])
+            before, after = cutText(fnp_text, 'FOOTNOTE')
+            if after is not None:
                 #add the text before the 'FOOTNOTE' to the previous stop's excerpt
-                to_prev = {'sents':[{'text':fnp_text.split('FOOTNOTE')[0]}]}
-                appendNoEntPara(stops, to_prev)
+                appendNoEntPara(stops, before)
                 #add the rest to the footnotes list of paragraphs
-                fnp_text_rest = {'sents':[{'text':'FOOTNOTE' + fnp_text.split('FOOTNOTE')[1]}]}
-                footnote.append(joinSents(fnp_text_rest['sents']))
+                footnote.append(joinSents(['FOOTNOTE' + after]))
             else:
-                footnote.append(joinSents(p['sents']))
+                footnote.append(p['_joined'])
         #join all of the sents for the footnote
         fn = lineBreaks(''.join(footnote), formatting=formatting)
         #create the stop for the footnote
@@ -940,19 +1029,17 @@ for k, t in tours.items():
         stop['lead-in'] = fn[0:35] + '...'
         stop['excerpt'] = fn
         stop['tour'] = 'Back matter'
-        stops.append(stop.copy())
+        appendStop(stops, stop)
         #process the WORD ABOUT
         for i, p in enumerate(t['paragraphs'][wa_p:]):
-            wap_text = joinSents(p['sents'])
-            if 'A WORD ABOUT' in wap_text:
+            before, after = cutText(p['_joined'], 'A WORD ABOUT')
+            if after is not None:
                 #add the text before 'A WORD ABOUT' to the previous stop's excerpt
-                to_prev = {'sents':[{'text':wap_text.split('A WORD ABOUT')[0]}]}
-                appendNoEntPara(stops, to_prev)
-                #add the rest to the footnotes list of paragraphs
-                wap_text_rest = {'sents':[{'text':'A WORD ABOUT' + wap_text.split('A WORD ABOUT')[1]}]}
-                wordabout.append(joinSents(wap_text_rest['sents']))
+                appendNoEntPara(stops, before)
+                #add the rest to the word-about list of paragraphs
+                wordabout.append(joinSents(['A WORD ABOUT' + after]))
             else:
-                wordabout.append(joinSents(p['sents']))
+                wordabout.append(p['_joined'])
         #join all of the sents
         wa = lineBreaks(' '.join(wordabout), formatting=formatting)
         #create the stop for the word about the author
@@ -961,38 +1048,46 @@ for k, t in tours.items():
         stop['lead-in'] = wa[0:35] + '...'
         stop['excerpt'] = lineBreaks(wa.replace('Top of page', ''), formatting=formatting)
         stop['tour'] = 'Back matter'
-        stops.append(stop.copy())
+        appendStop(stops, stop)
 
 
 # ### Make final edits to stops
 # Some stops are just references to other trees and not about the actual trees on the tour, so we should delete these. I compiled a list manually in the 'pp-tree-trails_deletes.json' file.
 
+#one alternation covering HTML tags and the markdown markers, so stripping is a single scan.
+#[^>]*? can't backtrack past a closing bracket the way .*? can
+MARKUP_RE = re.compile(r'<[^>]*?>|\*\*|_')
+
 def stripMarkup(text):
     """Remove HTML and markdown markup from text"""
-    text = text.replace('**', '').replace('_', '')
-    clean = re.compile('<.*?>')
-    return re.sub(clean, '', text)
+    return MARKUP_RE.sub('', text)
 
 #open the manually created list of entries to delete
 d = open('pp-tree-trails_deletes.json', 'r')
 deletes = json.load(d)
 
-#check the lead-in and species of each stop against the list of deletes and add to a new final_stops list if not in the deletes list
+#index the deletes by (lead-in, species) so each stop is a single set lookup rather than a
+#scan over the whole deletes list
+delete_keys = {(d['lead-in'], d['species']) for d in deletes}
+
+#check the lead-in and species of each stop against the deletes and add to a new final_stops list if not in the deletes list,
+#tracking the start of the current run of same-lead-in stops as we go
 final_stops = []
-for i, s in enumerate(stops):
-    if not any((s['lead-in'] == d['lead-in']) and (s['species'] == d['species']) for d in deletes):
+final_run_start = 0
+#pair each stop with the next stop's lead-in (None at the end of the list), so the
+#only-instance check below needs no index arithmetic and can't run off the end
+for s, next_leadin in zip(stops, chain((n['lead-in'] for n in islice(stops, 1, None)), [None])):
+    if (s['lead-in'], s.get('species')) not in delete_keys:
+        if len(final_stops) == 0 or final_stops[-1]['lead-in'] != s['lead-in']:
+            final_run_start = len(final_stops)
         final_stops.append(s)
     #if deleting the stop means deleting the only instance of the paragraph(s), then remove the formatting and 
-    #add it to the previous stop
+    #add it to the previous stop (or the whole run of stops, if the previous paragraph was repeated for multiple entities)
     else:
-        if final_stops[-1]['lead-in'] != s['lead-in'] and stops[i+1]['lead-in'] != s['lead-in']:
-            final_stops[-1]['excerpt'] = final_stops[-1]['excerpt'] + '\n' + stripMarkup(s['excerpt'])
-            #if there is more than one stop with that lead-in, add it to all of them
-            if len(final_stops) > 1:
-                prev_stop = -2
-                while final_stops[prev_stop]['lead-in'] ==  final_stops[-1]['lead-in']:
-                    final_stops[prev_stop]['excerpt'] = final_stops[prev_stop]['excerpt'] + '\n' + stripMarkup(s['excerpt'])  
-                    prev_stop = prev_stop - 1
+        if final_stops[-1]['lead-in'] != s['lead-in'] and next_leadin != s['lead-in']:
+            appended = '\n' + stripMarkup(s['excerpt'])
+            for fs in final_stops[final_run_start:]:
+                fs['excerpt'] = fs['excerpt'] + appended
         
 #add sequence numbers in case the list needs to get resorted
 seq = 1
@@ -1004,24 +1099,18 @@ for f in final_stops:
 # ### Write the final tour stop list out ot CSV
 
 #write to CSV for import into app
-stop_out = open('tree_trails.csv', 'w')
-writeStopsToCsv(final_stops, stop_out)
+#a large write buffer keeps the one-shot dump of all the (rich text) excerpts from flushing
+#in small pieces
+with open('tree_trails.csv', 'w', newline='', buffering=1<<20, encoding='utf-8') as stop_out:
+    writeStopsToCsv(final_stops, stop_out)
 
 
 # ### Reduce the tree species list to only those that appear in the guide and write to CSV
 
-final_tree_species = []
-sections = [t['paragraphs'] for k, t, in tours.items()]
-for ts in tree_species:
-    in_final = False
-    for s in sections:
-        for p in s:
-            for k, m in p['merged_ents'].items():
-                if ts['id'] == k:
-                    if in_final == False:
-                        final_tree_species.append(ts)
-                        in_final = True
-    
+#collect the ids of every species that actually appears in a paragraph, then filter the
+#species list against that set (keeping its original order)
+used_ids = {k for t in tours.values() for p in t['paragraphs'] for k in p.get('merged_ents', {})}
+final_tree_species = [ts for ts in tree_species if ts['id'] in used_ids]
 
 writeSpeciesToCsv(final_tree_species)
 